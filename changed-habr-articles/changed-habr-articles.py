@@ -1,21 +1,76 @@
 import os
+import re
+import html
+import json
 import subprocess
 import requests
-import xml.etree.ElementTree as ET
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from concurrent.futures import ThreadPoolExecutor
+from operator import itemgetter
+from lxml import etree
 from datetime import datetime
-from transliterate import translit
+from transliterate import get_translit_function
 from PIL import Image
 from io import BytesIO
 import sys
 
+pyvips_error = None
+try:
+    import pyvips  # Faster resize/encode with shrink-on-load, Pillow is used if unavailable
+except Exception as e:  # Not only ImportError: without system libvips pyvips raises OSError or Exception
+    pyvips = None
+    pyvips_error = e
+
 # Constants
 REPO_PATH = './website'
 CONTENT_PATH = os.path.join(REPO_PATH, 'content/ru/_articles')
 IMG_PATH = os.path.join(REPO_PATH, 'public/img/articles')
 GITHUB_REPO_URL = 'git@github.com:wirenboard/website.git'
 HABR_RSS_FEED_URL = 'https://habr.com/ru/rss/companies/wirenboard/articles/?fl=ru'
+FEED_CREATOR_TAG = "{http://purl.org/dc/elements/1.1/}creator"  # dc:creator, namespace resolved up front
+FEED_CACHE_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), '.habr_cache.json')
+SEEN_URLS_CACHE_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), '.seen_urls.json')
 EXCLUDE_KEYWORDS = ["интервью", "выставка", "репортаж", "конференция", "wbce"]
 EXCLUDE_AUTHORS = ["lavritech", "another_author"]  # List of excluded authors
+EXCLUDE_AUTHORS_RE = re.compile("|".join(map(re.escape, EXCLUDE_AUTHORS)), re.IGNORECASE)
+EXCLUDE_KEYWORDS_RE = re.compile("|".join(map(re.escape, EXCLUDE_KEYWORDS)), re.IGNORECASE)
+# Characters dropped from filenames: everything except alphanumerics and spaces
+FILENAME_DISALLOWED_RE = re.compile(r"[^\w ]|_")
+IMG_SRC_RE = re.compile(r"<img\s(?:[^>]*?\s)?src\s*=\s*[\"']([^\"']+)", re.IGNORECASE)
+# RFC 822 month names, as used in RSS pubDate
+PUB_DATE_MONTHS = {
+    "Jan": "01", "Feb": "02", "Mar": "03", "Apr": "04", "May": "05", "Jun": "06",
+    "Jul": "07", "Aug": "08", "Sep": "09", "Oct": "10", "Nov": "11", "Dec": "12",
+}
+MARKDOWN_TEMPLATE = b"""---
+title: "%s"
+url: %s
+cover: /img/articles/%s.webp
+date: %s
+category: IMPORTED_SELECT_CATEGORY
+---"""
+IMAGE_WIDTH = 500  # Width of saved cover images, px
+MAX_IMAGE_SIZE = 20 * 1024 * 1024  # Maximum cover image download size, bytes
+REQUEST_TIMEOUT = 10  # Seconds
+IMAGE_DOWNLOAD_WORKERS = 8  # Keep low to avoid throttling on the image host
+
+# Shared HTTP session so keep-alive connections are reused by the RSS request and all image downloads
+session = requests.Session()
+http_adapter = HTTPAdapter(
+    pool_connections=IMAGE_DOWNLOAD_WORKERS,
+    pool_maxsize=IMAGE_DOWNLOAD_WORKERS,
+    max_retries=Retry(total=3, backoff_factor=0.3, status_forcelist=[429, 500, 502, 503, 504]),
+)
+session.mount("https://", http_adapter)
+session.mount("http://", http_adapter)
+
+# Language pack is instantiated once instead of on every translit() call
+translit_ru = get_translit_function('ru')
+
+# Accessors for article dicts returned by fetch_habr_articles
+get_article_link = itemgetter("link")
+get_article_fields = itemgetter("title", "link", "image_url", "date")
 
 # Flags
 dry_run = "--dry-run" in sys.argv
@@ -34,10 +89,13 @@ def emulate_log(message):
     """Log messages during dry run mode."""
     print(f"[EMULATION] {message}")
 
-def transliterate_filename(title):
-    """Transliterate and clean title for filename compatibility."""
-    translit_title = translit(title, 'ru', reversed=True).lower()
-    clean_title = "".join([char if char.isalnum() or char == " " else "" for char in translit_title])
+def transliterate_filename(title, existing_filenames):
+    """Transliterate and clean title for filename compatibility.
+
+    The chosen name is added to existing_filenames so later calls don't reuse it.
+    """
+    translit_title = translit_ru(title, reversed=True).lower()
+    clean_title = FILENAME_DISALLOWED_RE.sub("", translit_title)
     words = clean_title.split()
 
     # Limit to 7 words
@@ -46,10 +104,11 @@ def transliterate_filename(title):
     # Check for existing filenames
     base_filename = filename
     counter = 1
-    while os.path.exists(os.path.join(CONTENT_PATH, f"{filename}.md")):
+    while filename in existing_filenames:
         filename = f"{base_filename}_{counter}"
         counter += 1
 
+    existing_filenames.add(filename)
     return filename
 
 def run_command(command):
@@ -61,109 +120,251 @@ def run_command(command):
         sys.exit(1)
 
 def clone_or_update_repo():
-    """Clone repo if it doesn't exist, else pull latest and clean."""
+    """Clone repo if it doesn't exist, else fetch latest main and clean.
+
+    Only the latest commit of main is fetched, history isn't needed to add articles.
+    """
     if not os.path.exists(REPO_PATH):
         log("Cloning repository...")
-        run_command(["git", "clone", GITHUB_REPO_URL, REPO_PATH])
+        run_command(["git", "clone", "--depth=1", "--single-branch", "--branch", "main", GITHUB_REPO_URL, REPO_PATH])
     else:
-        log("Repository already exists. Pulling latest changes and cleaning...")
+        log("Repository already exists. Fetching latest changes and cleaning...")
+        run_command(["git", "-C", REPO_PATH, "-c", "gc.auto=0", "fetch", "--depth=1", "origin", "main"])
         run_command(["git", "-C", REPO_PATH, "checkout", "main"])
-        run_command(["git", "-C", REPO_PATH, "pull"])
+        run_command(["git", "-C", REPO_PATH, "reset", "--hard", "origin/main"])
         run_command(["git", "-C", REPO_PATH, "clean", "-fd"])
 
-def fetch_habr_articles():
-    """Fetch articles from Habr RSS feed and filter based on criteria."""
-    response = requests.get(HABR_RSS_FEED_URL)
+def format_pub_date(pub_date):
+    """Convert RSS pubDate (e.g. 'Mon, 07 Oct 2024 10:00:00 GMT') to YYYY-MM-DD."""
+    # pubDate layout is fixed, so avoid going through strptime's locale tables
+    parts = pub_date.split()
+    if len(parts) >= 4 and parts[2] in PUB_DATE_MONTHS and parts[1].isdigit() and parts[3].isdigit():
+        return f"{parts[3]}-{PUB_DATE_MONTHS[parts[2]]}-{parts[1].zfill(2)}"
+    return datetime.strptime(pub_date, "%a, %d %b %Y %H:%M:%S %Z").strftime("%Y-%m-%d")
+
+def load_feed_cache():
+    """Load ETag/Last-Modified of the previously processed RSS feed."""
+    try:
+        with open(FEED_CACHE_PATH) as file:
+            return json.load(file)
+    except (OSError, ValueError):
+        return {}
+
+def save_feed_cache(feed_cache):
+    """Persist ETag/Last-Modified of the processed RSS feed."""
+    with open(FEED_CACHE_PATH, "w") as file:
+        json.dump(feed_cache, file)
+    debug_log(f"Feed cache saved: {FEED_CACHE_PATH}")
+
+def fetch_habr_articles(feed_cache):
+    """Fetch articles from Habr RSS feed and filter based on criteria.
+
+    Sends a conditional request using validators from feed_cache and updates it
+    with the ones from the response. Returns an empty list if the feed is unchanged.
+    """
+    headers = {}
+    if feed_cache.get("etag"):
+        headers["If-None-Match"] = feed_cache["etag"]
+    if feed_cache.get("last_modified"):
+        headers["If-Modified-Since"] = feed_cache["last_modified"]
+    response = session.get(HABR_RSS_FEED_URL, headers=headers, timeout=REQUEST_TIMEOUT)
+    if response.status_code == 304:
+        log("Habr RSS feed is not modified since last run.")
+        return []
     response.raise_for_status()
-    root = ET.fromstring(response.content)
+    feed_cache["etag"] = response.headers.get("ETag")
+    feed_cache["last_modified"] = response.headers.get("Last-Modified")
     articles, excluded = [], []
 
-    for item in root.findall(".//item"):
-        title = item.find("title").text or ""
-        description = item.find("description").text or ""
-        creator = item.find("{http://purl.org/dc/elements/1.1/}creator").text or ""
-        categories = [cat.text for cat in item.findall("category") if cat.text]
-        pub_date = item.find("pubDate").text or ""
-        date_formatted = datetime.strptime(pub_date, "%a, %d %b %Y %H:%M:%S %Z").strftime("%Y-%m-%d")
+    # Parse item by item, dropping processed ones to keep only one in memory
+    for _, item in etree.iterparse(BytesIO(response.content), tag="item"):
+        title = item.findtext("title", "")
+        description = item.findtext("description", "")
+        creator = item.findtext(FEED_CREATOR_TAG, "")
+        categories = [cat.text for cat in item.iterchildren("category") if cat.text]
+        pub_date = item.findtext("pubDate", "")
+        link = item.findtext("link").split('?')[0]
+        date_formatted = format_pub_date(pub_date)
 
         exclusion_reason = None
-        if any(author.lower() in creator.lower() for author in EXCLUDE_AUTHORS):
+        if EXCLUDE_AUTHORS_RE.search(creator):
             exclusion_reason = "author excluded"
-        elif any(keyword in title.lower() + description.lower() for keyword in EXCLUDE_KEYWORDS):
+        elif EXCLUDE_KEYWORDS_RE.search(title) or EXCLUDE_KEYWORDS_RE.search(description):
             exclusion_reason = "keyword in title/description"
-        elif any(keyword in category.lower() for category in categories for keyword in EXCLUDE_KEYWORDS):
+        elif any(EXCLUDE_KEYWORDS_RE.search(category) for category in categories):
             exclusion_reason = "keyword in category"
 
         if exclusion_reason:
-            excluded.append(f"{item.find('link').text.split('?')[0]} — exclusion reason: {exclusion_reason}")
+            excluded.append(f"{link} — exclusion reason: {exclusion_reason}")
         else:
             articles.append({
                 "title": title,
-                "link": item.find("link").text.split('?')[0],
+                "link": link,
                 "image_url": extract_image_url(description),
                 "date": date_formatted
             })
 
+        item.clear()
+        while item.getprevious() is not None:
+            del item.getparent()[0]
+
     log(f"Excluded Habr articles: {len(excluded)}")
     for article in excluded:
         debug_log(article)
 
     return articles
 
+def read_article_urls(md_file_path):
+    """Read all url fields from the markdown file, like grep "^url: " did."""
+    urls = []
+    # utf-8-sig strips a BOM, undecodable bytes must not hide the url line
+    with open(md_file_path, encoding="utf-8-sig", errors="replace") as file:
+        for line in file:
+            if line.startswith("url: "):
+                urls.append(line.removeprefix("url: ").strip())
+    return urls
+
+def get_content_tree_hash():
+    """Return git tree hash of the articles directory at HEAD, or None on error."""
+    result = subprocess.run(
+        ["git", "-C", REPO_PATH, "rev-parse", f"HEAD:{os.path.relpath(CONTENT_PATH, REPO_PATH)}"],
+        text=True, capture_output=True
+    )
+    if result.returncode != 0:
+        debug_log(f"Failed to get articles tree hash: {result.stderr.strip()}")
+        return None
+    return result.stdout.strip()
+
 def fetch_github_articles():
-    """Fetch existing article URLs from the GitHub repository to avoid duplicates."""
-    github_articles = []
+    """Fetch existing article URLs from the GitHub repository to avoid duplicates.
+
+    URLs are cached by the git tree hash of the articles directory, so the files
+    are only read again when the directory changes.
+    """
+    tree_hash = get_content_tree_hash()
+    try:
+        with open(SEEN_URLS_CACHE_PATH) as file:
+            cache = json.load(file)
+        if tree_hash and cache.get("tree_hash") == tree_hash:
+            github_articles = set(cache["urls"])
+            log(f"Fetched {len(github_articles)} existing articles from GitHub (cached).")
+            return github_articles
+    except (OSError, ValueError, KeyError):
+        pass
+
+    github_articles = set()
     try:
-        result = subprocess.run(
-            ["grep", "-hr", "^url: ", CONTENT_PATH],
-            text=True, capture_output=True, check=True
-        )
-        for line in result.stdout.splitlines():
-            _, url = line.split("url: ")
-            github_articles.append(url.strip())
+        for dir_path, _, file_names in os.walk(CONTENT_PATH):
+            for file_name in file_names:
+                if not file_name.endswith(".md"):
+                    continue
+                github_articles.update(read_article_urls(os.path.join(dir_path, file_name)))
         log(f"Fetched {len(github_articles)} existing articles from GitHub.")
-    except subprocess.CalledProcessError as e:
+    except OSError as e:
         log(f"Error fetching articles from GitHub: {e}")
-        return []
+        return set()
+
+    if tree_hash:
+        with open(SEEN_URLS_CACHE_PATH, "w") as file:
+            json.dump({"tree_hash": tree_hash, "urls": sorted(github_articles)}, file)
+        debug_log(f"Seen URLs cache saved: {SEEN_URLS_CACHE_PATH}")
     return github_articles
 
 def extract_image_url(description):
     """Extract image URL from the description HTML."""
-    if "<img src=" in description:
-        start = description.find("<img src=") + len("<img src=\"")
-        end = description.find("\"", start)
-        return description[start:end]
-    return None
+    match = IMG_SRC_RE.search(description)
+    return html.unescape(match.group(1)) if match else None
+
+def copy_response_body(response, output):
+    """Copy streamed response body to output file object, refusing files larger than MAX_IMAGE_SIZE."""
+    content_length = int(response.headers.get("Content-Length") or 0)
+    if content_length > MAX_IMAGE_SIZE:
+        raise ValueError(f"image is too large ({content_length} bytes)")
+    size = 0
+    for chunk in response.iter_content(chunk_size=64 * 1024):
+        output.write(chunk)
+        size += len(chunk)
+        if size > MAX_IMAGE_SIZE:
+            raise ValueError(f"image exceeds {MAX_IMAGE_SIZE} bytes")
+
+def download_image(image_url, image_path):
+    """Download image and return its bytes.
+
+    WebP images are streamed straight to image_path instead, as they usually need
+    no processing, and None is returned.
+    """
+    with session.get(image_url, stream=True, timeout=REQUEST_TIMEOUT) as response:
+        response.raise_for_status()  # Check for request errors
+        if response.headers.get("Content-Type", "").split(";")[0].strip() == "image/webp":
+            with open(image_path, "wb") as file:
+                copy_response_body(response, file)
+            return None
+        buffer = BytesIO()
+        copy_response_body(response, buffer)
+        return buffer.getvalue()
+
+def resize_image_vips(image_data, image_path):
+    """Resize image to IMAGE_WIDTH and save as .webp using libvips."""
+    # Huge height so only the width limits the size, like Pillow's thumbnail below
+    image = pyvips.Image.thumbnail_buffer(image_data, IMAGE_WIDTH, height=10_000_000, size="down")
+    if image.hasalpha():
+        image = image.flatten()
+    image = image.colourspace("srgb")
+    image.write_to_file(image_path, Q=80, strip=True)
+
+def resize_image_pillow(image, image_path):
+    """Resize image to IMAGE_WIDTH and save as .webp using Pillow."""
+    if image.width > IMAGE_WIDTH:
+        # Let the JPEG decoder downscale while decoding, thumbnail only finishes the job
+        image.draft("RGB", (IMAGE_WIDTH, max(1, image.height * IMAGE_WIDTH // image.width)))
+        image = image.convert("RGB")
+        image.thumbnail((IMAGE_WIDTH, image.height), Image.LANCZOS)  # Use LANCZOS for high-quality downsampling
+    else:
+        image = image.convert("RGB")  # Already small enough, only transcode
+    image.save(image_path, "webp", quality=80, method=4)
 
 def save_image(image_url, filename):
     """Download and save image as a 500px width .webp file."""
+    image_path = os.path.join(IMG_PATH, f"{filename}.webp")
     try:
-        response = requests.get(image_url)
-        response.raise_for_status()  # Check for request errors
-        image = Image.open(BytesIO(response.content))
-        image = image.convert("RGB")
-        image.thumbnail((500, image.height), Image.LANCZOS)  # Use LANCZOS for high-quality downsampling
-        image_path = os.path.join(IMG_PATH, f"{filename}.webp")
-        image.save(image_path, "webp")
+        image_data = download_image(image_url, image_path)
+        if image_data is None:
+            # Already on disk as WebP, done unless it is too wide
+            with Image.open(image_path) as image:
+                if image.format == "WEBP" and image.width <= IMAGE_WIDTH:
+                    debug_log(f"Image saved: {image_path}")
+                    return image_path
+            with open(image_path, "rb") as file:
+                image_data = file.read()
+        # Image.open only reads the header here, pixels are decoded on demand
+        image = Image.open(BytesIO(image_data))
+        if image.format == "WEBP" and image.width <= IMAGE_WIDTH:
+            # Nothing to resize or transcode, keep the original bytes
+            with open(image_path, "wb") as file:
+                file.write(image_data)
+        elif pyvips:
+            resize_image_vips(image_data, image_path)
+        else:
+            resize_image_pillow(image, image_path)
         debug_log(f"Image saved: {image_path}")
         return image_path
     except Exception as e:
         log(f"Failed to save image {image_url}: {e}")
+        # Don't leave a streamed or partly written file behind
+        if os.path.exists(image_path):
+            os.remove(image_path)
         return None
 
 def create_markdown_file(title, link, filename, date):
     """Create markdown file for article."""
-    md_content = f"""---
-title: "{title}"
-url: {link}
-cover: /img/articles/{filename}.webp
-date: {date}
-category: IMPORTED_SELECT_CATEGORY
----"""
+    md_content = MARKDOWN_TEMPLATE % (title.encode(), link.encode(), filename.encode(), date.encode())
 
     md_file_path = os.path.join(CONTENT_PATH, f"{filename}.md")
-    with open(md_file_path, "w") as file:
-        file.write(md_content)
+    fd = os.open(md_file_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+    try:
+        os.write(fd, md_content)
+    finally:
+        os.close(fd)
     debug_log(f"Markdown file created: {md_file_path}")
     return md_file_path
 
@@ -213,6 +414,13 @@ def create_pull_request(commit_message, pr_body, dry_run):
 
 
 
+def list_directory_paths(path):
+    """Return paths of entries in the directory, empty set if it doesn't exist."""
+    try:
+        return {entry.path for entry in os.scandir(path)}
+    except FileNotFoundError:
+        return set()
+
 def commit_and_push_changes(created_files, dry_run=False):
     """Commit and push changes to the repository, or emulate if dry_run is True."""
     branch_name = f"feature/add-new-articles-{datetime.now().strftime('%Y%m%d')}"
@@ -239,21 +447,29 @@ def commit_and_push_changes(created_files, dry_run=False):
         "Category file: https://github.com/wirenboard/website/blob/main/common/article_categories.ts"
     )
 
+    # One directory listing per target dir instead of two stats per article
+    existing_files = list_directory_paths(CONTENT_PATH) | list_directory_paths(IMG_PATH)
+
+    files_to_add = []
     for md_file, img_file in created_files:
+        # We check if there are files before adding (img_file is None if download failed)
+        if md_file not in existing_files or img_file not in existing_files:
+            log(f"Warning: File(s) not found for commit: {md_file}, {img_file}")
+            continue
+
         # Relative ways for Git Add
         md_file_rel = os.path.relpath(md_file, REPO_PATH)
         img_file_rel = os.path.relpath(img_file, REPO_PATH)
 
-        # We check if there are files before adding
-        if not os.path.exists(md_file) or not os.path.exists(img_file):
-            log(f"Warning: File(s) not found for commit: {md_file}, {img_file}")
-            continue
-
         if dry_run:
             emulate_log(f"Adding file: {md_file_rel}")
             emulate_log(f"Adding file: {img_file_rel}")
         else:
-            run_command(["git", "-C", REPO_PATH, "add", md_file_rel, img_file_rel])
+            files_to_add += [md_file_rel, img_file_rel]
+
+    # Single git add for all files instead of one process per article
+    if files_to_add:
+        run_command(["git", "-C", REPO_PATH, "add", "--"] + files_to_add)
 
     commit_changes(dry_run, commit_message)
     push_changes(branch_name, dry_run)
@@ -262,24 +478,45 @@ def commit_and_push_changes(created_files, dry_run=False):
 
 
 def main():
-    clone_or_update_repo()
-    habr_articles = fetch_habr_articles()
+    if pyvips_error:
+        debug_log(f"pyvips is unavailable, using Pillow: {pyvips_error}")
+    # The RSS feed doesn't depend on the local repo, fetch it while git is busy
+    feed_cache = load_feed_cache()
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        habr_future = executor.submit(fetch_habr_articles, feed_cache)
+        clone_or_update_repo()
+        habr_articles = habr_future.result()
     github_articles = fetch_github_articles()
-    new_articles = [article for article in habr_articles if article["link"] not in github_articles]
+    new_articles = [article for article in habr_articles if get_article_link(article) not in github_articles]
 
     if not new_articles:
         log("No new articles to process.")
+        if not dry_run:
+            save_feed_cache(feed_cache)
         return
 
     log(f"Found {len(new_articles)} new articles to process.")
+    existing_filenames = {
+        entry.name.removesuffix(".md") for entry in os.scandir(CONTENT_PATH) if entry.name.endswith(".md")
+    }
     created_files = []
-    for article in new_articles:
-        filename = transliterate_filename(article["title"])
-        md_file = create_markdown_file(article["title"], article["link"], filename, article["date"])
-        img_file = save_image(article["image_url"], filename)
-        created_files.append((md_file, img_file))
+    with ThreadPoolExecutor(max_workers=IMAGE_DOWNLOAD_WORKERS) as executor:
+        futures = []
+        for article in new_articles:
+            title, link, image_url, date = get_article_fields(article)
+            # Filenames are picked sequentially: uniqueness depends on names already taken
+            filename = transliterate_filename(title, existing_filenames)
+            md_future = executor.submit(create_markdown_file, title, link, filename, date)
+            img_future = executor.submit(save_image, image_url, filename)
+            futures.append((md_future, img_future))
+
+        for md_future, img_future in futures:
+            created_files.append((md_future.result(), img_future.result()))
 
     commit_and_push_changes(created_files, dry_run=dry_run)
+    # Saved only if every article was committed, so skipped ones are retried on the next run
+    if not dry_run and all(img_file for _, img_file in created_files):
+        save_feed_cache(feed_cache)
 
 if __name__ == "__main__":
     main()